@@ -44,16 +44,22 @@ explicitly. It is however not permitted to use timestamps older than the latest
 in use. Nor is it allowed to perform a change action with a timestamp not newer
 than the previous action on a key.
 
+# Bulk loading
+`ChangeDataDict.from_sorted_pairs` restores a history of
+(key, [(ts, value, deleted), ...]) pairs without replaying every change.
+The timestamps of every key must already be in strictly increasing order.
+
 # Read / Write independence
 NOTE: Change actions are always appended to history, but read actions are
 independent of writing. Hence if the lookup type is not latest, change actions
 may not be reflected in subsequent reads.
 """
 
-import calendar
-from collections import MutableMapping
-from datetime import datetime
+import bisect
+from collections.abc import MutableMapping
+from itertools import chain
 import json
+import time
 
 
 class LookupType(object):
@@ -62,14 +68,51 @@ class LookupType(object):
     TIMESTAMP = 3
 
 
+_VALID_LOOKUPS = frozenset(
+    [LookupType.LAST, LookupType.FIRST, LookupType.TIMESTAMP])
+
+
+def _value_hash(value):
+    try:
+        return hash(value)
+    except TypeError:
+        return None  # Unhashable, e.g. a dict or list
+
+
+class _Change(object):
+    # A single change action as found in the history of a key
+    __slots__ = ('ts', 'value', 'deleted')
+
+    def __init__(self, ts, value, deleted):
+        self.ts = ts
+        self.value = value
+        self.deleted = deleted
+
+
 class ChangeDataDict(MutableMapping):
     # TODO: For diff function, to be able to differentiate
     DELETED = (None, 'DELETED')
     NON_EXISTENT = (None, 'NON_EXISTENT')
 
+    __slots__ = (
+        '_ts', '_values', '_deleted', '_versions', '_sources', '_last',
+        '_last_hash', '_getitem_cache', '_lookup_type',
+        '_lookup_ts', '_latest_ts', '_set_ts', '_lazy_update', '_version',
+        '_source', '_extras', '__weakref__',
+    )
+
     def __init__(self, dic=None, lookup_type=None, lookup_ts=None, set_ts=None,
                  lazy_update=False, version=None, source=None):
-        self._store = dict()
+        # History is stored per key as parallel lists, one per property
+        self._ts = dict()
+        self._values = dict()
+        self._deleted = dict()  # bytearray, 1 if the action was a deletion
+        self._versions = dict()  # Only populated if version is used
+        self._sources = dict()  # Only populated if source is used
+        self._last = dict()  # Latest _Change per key
+        self._last_hash = dict()  # Hash of the latest value, for lazy_update
+        # Last lookup per key as (lookup_type, lookup_ts, item)
+        self._getitem_cache = dict()
         self._lookup_type = LookupType.LAST
         self._lookup_ts = None
         self._latest_ts = 0
@@ -77,6 +120,8 @@ class ChangeDataDict(MutableMapping):
         self._lazy_update = lazy_update
         self._version = version
         self._source = source
+        # Version and source are fixed for the lifetime of the dict
+        self._extras = version is not None or source is not None
 
         # set_ts has to be in effect before self.update
         if set_ts is not None:
@@ -89,13 +134,46 @@ class ChangeDataDict(MutableMapping):
         if lookup_ts is not None:
             self.lookup_ts = lookup_ts
 
+    @classmethod
+    def from_sorted_pairs(cls, pairs, **kwargs):
+        # Bulk load history as (key, [(ts, value, deleted), ...]) pairs, e.g.
+        # to restore persisted state. The changes of every key have to be in
+        # strictly increasing order of timestamp, which is NOT validated.
+        # Any other arguments are passed on to the constructor.
+        cdd = cls(**kwargs)
+        latest_ts = cdd._latest_ts
+        for key, changes in pairs:
+            changes = list(changes)
+            if not changes:
+                continue
+            ts_list, values, deleted = zip(*changes)
+            cdd._ts[key] = list(ts_list)
+            cdd._values[key] = list(values)
+            cdd._deleted[key] = bytearray(deleted)
+            if cdd.version is not None:
+                cdd._versions[key] = [cdd.version] * len(changes)
+            if cdd.source is not None:
+                cdd._sources[key] = [cdd.source] * len(changes)
+            last = _Change(ts_list[-1], values[-1], bool(deleted[-1]))
+            cdd._last[key] = last
+            # A key may already have a history, e.g. from dic or a duplicate
+            if cdd.lazy_update and not last.deleted:
+                cdd._last_hash[key] = _value_hash(last.value)
+            else:
+                cdd._last_hash.pop(key, None)
+            latest_ts = max(latest_ts, last.ts)
+        cdd._latest_ts = latest_ts
+        if cdd.set_ts is not None and cdd.set_ts < latest_ts:
+            raise ValueError(cdd.set_ts)
+        return cdd
+
     @property
     def lookup_type(self):
         return self._lookup_type
 
     @lookup_type.setter
     def lookup_type(self, value):
-        if value in range(1, 4):  # TODO: Easy, clean check on LookupType
+        if value in _VALID_LOOKUPS:
             self._lookup_type = value
         else:
             raise ValueError(value)
@@ -140,115 +218,231 @@ class ChangeDataDict(MutableMapping):
         return self._source
 
     def _get_item(self, key, lookup_type, lookup_ts=None):
-        history = self._store[key]
-        cur_item = None
         if lookup_type == LookupType.LAST:
-            cur_item = history[-1]
-        elif lookup_type == LookupType.FIRST:
-            cur_item = history[0]
+            return self._last[key]
+        ts_list = self._ts[key]
+        if lookup_type == LookupType.FIRST:
+            idx = 0
         elif lookup_type == LookupType.TIMESTAMP:
-            # TODO: Faster implementation
-            for item in history:
-                if item['ts'] > lookup_ts:
-                    break
-                cur_item = item
-        return cur_item
+            # History is ordered by timestamp, so a binary search suffices
+            idx = bisect.bisect_right(ts_list, lookup_ts) - 1
+            if idx < 0:
+                return None
+        else:
+            return None
+        return _Change(ts_list[idx], self._values[key][idx],
+                       bool(self._deleted[key][idx]))
 
     def get_item(self, key):
-        return self._get_item(key, self.lookup_type, lookup_ts=self.lookup_ts)
+        lookup_type = self._lookup_type
+        if lookup_type == LookupType.LAST:
+            return self._last[key]
+        lookup_ts = self._lookup_ts
+        cached = self._getitem_cache.get(key)
+        if cached is not None and cached[0] == lookup_type and \
+                cached[1] == lookup_ts:
+            return cached[2]
+        item = self._get_item(key, lookup_type, lookup_ts=lookup_ts)
+        self._getitem_cache[key] = (lookup_type, lookup_ts, item)
+        return item
 
     def __getitem__(self, key):
         cur_item = self.get_item(key)
         if cur_item is None:
             raise KeyError(key)
-        if cur_item.get('del', False):
+        if cur_item.deleted:
             raise KeyError(key)
-        return cur_item['value']
+        return cur_item.value
 
-    def _create_item(self, value, delete=False, prior_ts=None):
+    def _current_ts(self):
         if self.set_ts is not None:
-            ts = self.set_ts
+            return self.set_ts
+        return int(time.time())
+
+    def _append_change(self, key, value, delete=False, ts=None):
+        if ts is None:
+            ts = self._current_ts()
+        last = self._last
+        if key in last:
+            if last[key].ts >= ts:
+                raise ValueError(ts)
         else:
-            ts = calendar.timegm(datetime.utcnow().timetuple())
-        if prior_ts is not None and prior_ts >= ts:
-            raise ValueError(ts)
-        self._latest_ts = ts  # Because set_ts cannot be lower, this is latest
-        item = {'ts': ts, 'value': value}
-        if delete:
-            item['del'] = True
-        if self.version is not None:
-            item['version'] = self.version
-        if self.source is not None:
-            item['source'] = self.source
-        return item
+            self._ts[key] = []
+            self._values[key] = []
+            self._deleted[key] = bytearray()
+        # Because set_ts cannot be lower, this is latest
+        self._latest_ts = ts
+        self._getitem_cache.pop(key, None)  # Only this key's history changes
+        self._ts[key].append(ts)
+        self._values[key].append(value)
+        self._deleted[key].append(delete)
+        last[key] = _Change(ts, value, delete)
+        if self._extras:
+            if self.version is not None:
+                self._versions.setdefault(key, []).append(self.version)
+            if self.source is not None:
+                self._sources.setdefault(key, []).append(self.source)
 
     def prior_ts(self, key):
-        if key in self._store:
-            return self._store[key][-1]['ts']
+        if key in self._last:
+            return self._last[key].ts
         return None
 
     def prior_value_is_equal(self, key, value):
-        if key in self._store:
-            prior_value = self._store[key][-1]['value']
-            return prior_value == value
-        return False
+        return self._prior_value_is_equal(key, value, _value_hash(value))
+
+    def _prior_value_is_equal(self, key, value, value_hash):
+        if key not in self._last:
+            return False
+        # Values with different hashes cannot be equal, which avoids a
+        # deep comparison in most cases
+        prior_hash = self._last_hash.get(key)
+        if prior_hash is not None and value_hash is not None and \
+                prior_hash != value_hash:
+            return False
+        return self._last[key].value == value
 
     def __setitem__(self, key, value):
-        if self.lazy_update and self.prior_value_is_equal(key, value):
+        self._set_value(key, value)
+
+    def _set_value(self, key, value, ts=None):
+        if not self.lazy_update:
+            self._append_change(key, value, ts=ts)
             return
-        prior_ts = self.prior_ts(key)
-        item = self._create_item(value, prior_ts=prior_ts)
-        if key not in self._store:
-            self._store[key] = []
-        self._store[key].append(item)
+        value_hash = _value_hash(value)
+        if self._prior_value_is_equal(key, value, value_hash):
+            return
+        self._append_change(key, value, ts=ts)
+        self._last_hash[key] = value_hash
+
+    def update(self, other=(), /, **kwargs):
+        # The same timestamp is used for every key in the batch
+        ts = self._current_ts()
+        if not self._last and isinstance(other, dict) and not kwargs:
+            self._update_empty(other, ts)
+            return
+        if isinstance(other, dict):
+            pairs = other.items()
+        elif hasattr(other, 'keys'):
+            pairs = ((key, other[key]) for key in other.keys())
+        else:
+            pairs = other
+        for key, value in chain(pairs, kwargs.items()):
+            self._set_value(key, value, ts=ts)
+
+    def _update_empty(self, dic, ts):
+        # Without any history there is nothing to validate or compare to,
+        # so the history of every key can be created in one go
+        for key, value in dic.items():
+            self._ts[key] = [ts]
+            self._values[key] = [value]
+            self._deleted[key] = bytearray(1)
+            self._last[key] = _Change(ts, value, False)
+        if self.version is not None:
+            for key in dic:
+                self._versions[key] = [self.version]
+        if self.source is not None:
+            for key in dic:
+                self._sources[key] = [self.source]
+        if self.lazy_update:
+            for key, value in dic.items():
+                self._last_hash[key] = _value_hash(value)
+        if dic:
+            self._latest_ts = ts
 
     def prior_item_is_deleted(self, key):
-        if key in self._store:
-            return self._store[key][-1].get('del', False)
+        if key in self._last:
+            return self._last[key].deleted
         return False
 
     def __delitem__(self, key):
-        if not key in self._store:
+        if key not in self._last:
             raise KeyError(key)
         if self.prior_item_is_deleted(key):
             raise KeyError(key)
-        prior_ts = self.prior_ts(key)
-        item = self._create_item(None, delete=True, prior_ts=prior_ts)
-        self._store[key].append(item)
+        self._append_change(key, None, delete=True)
+        self._last_hash.pop(key, None)
 
     def __iter__(self):
-        for key in self._store:
+        if self._lookup_type == LookupType.LAST:
+            return self._iter_last()
+        return self._iter_lookup()
+
+    def _iter_last(self):
+        # Deleting only replaces the latest item, so this is safe to use
+        # while deleting keys
+        for key, item in self._last.items():
+            if not item.deleted:
+                yield key
+
+    def _iter_lookup(self):
+        lookup_ts = self._lookup_ts
+        is_ts_lookup = self._lookup_type == LookupType.TIMESTAMP
+        for key, ts_list in self._ts.items():
+            if is_ts_lookup and ts_list[0] > lookup_ts:
+                continue  # Key did not exist yet
             item = self.get_item(key)
-            if not item.get('del', False):
+            if item is not None and not item.deleted:
                 yield key
 
     def __len__(self):
-        return len(self._store)
+        return len(self._ts)
 
     def diff(self, lookup_type, lookup_ts=None):
+        deleted = self.DELETED
+        non_existent = self.NON_EXISTENT
 
         def to_value(item):
             if item is None:
-                return self.NON_EXISTENT
-            elif item.get('del', False):
-                return self.DELETED
-            return item['value']
-
+                return non_existent
+            elif item.deleted:
+                return deleted
+            return item.value
+
+        if lookup_type == self._lookup_type and \
+                (lookup_type != LookupType.TIMESTAMP or
+                 lookup_ts == self._lookup_ts):
+            return {}  # Every key would be compared to itself
+
+        get_item = self.get_item
+        get_comp_item = self._get_item
         diff = {}
-        for key in self._store:
-            cur_item = self.get_item(key)
-            comp_item = self._get_item(key, lookup_type, lookup_ts=lookup_ts)
-            value = to_value(cur_item)
-            comp_value = to_value(comp_item)
+        for key in self._ts:
+            value = to_value(get_item(key))
+            comp_value = to_value(get_comp_item(key, lookup_type, lookup_ts))
             if value != comp_value:
                 diff[key] = (value, comp_value)
         return diff
 
+    def _history(self, key):
+        # Rebuild the list of items in the format described at the top
+        values = self._values[key]
+        deleted = self._deleted[key]
+        versions = self._versions.get(key)
+        sources = self._sources.get(key)
+        history = []
+        for idx, ts in enumerate(self._ts[key]):
+            item = {'ts': ts, 'value': values[idx]}
+            if deleted[idx]:
+                item['del'] = True
+            if versions is not None:
+                item['version'] = versions[idx]
+            if sources is not None:
+                item['source'] = sources[idx]
+            history.append(item)
+        return history
+
     def to_dict(self, snapshot=False):
         # TODO: recursively handle ChangeDataDict
         if not snapshot:
-            return dict(self._store)
-        return dict(self.iteritems())
+            return {key: self._history(key) for key in self._ts}
+        return self._snapshot()
+
+    def _snapshot(self):
+        if self._lookup_type == LookupType.LAST:
+            return {key: item.value for key, item in self._last.items()
+                    if not item.deleted}
+        return {key: self[key] for key in self._iter_lookup()}
 
     def to_json(self, snapshot=False):
         return json.dumps(self.to_dict(snapshot=snapshot))
@@ -1,3 +1,5 @@
+import copy
+import pickle
 import unittest
 
 from main import ChangeDataDict, LookupType
@@ -14,7 +16,7 @@ class TestChangeDataDict(unittest.TestCase):
         self.assertEqual(cdd[3], 1.5)
 
         # Verify dict functions apply
-        self.assertEqual(sorted(cdd.keys()), [3, 'x', 'y'])
+        self.assertEqual(sorted(cdd.keys(), key=str), [3, 'x', 'y'])
         
         # Verify that non attributes return error
         with self.assertRaises(KeyError):
@@ -22,6 +24,28 @@ class TestChangeDataDict(unittest.TestCase):
 
         self.assertEqual(cdd.get('a', 1), 1)
 
+        # Attributes are slots, there is no instance dict
+        self.assertFalse(hasattr(cdd, '__dict__'))
+        with self.assertRaises(AttributeError):
+            cdd.x = 5
+
+    def test_update(self):
+        cdd = ChangeDataDict()
+        cdd.update({1: 5, 2: 3})
+        # All keys in a batch share the same timestamp
+        self.assertEqual(cdd.prior_ts(1), cdd.prior_ts(2))
+        self.assertEqual(cdd.prior_ts(1), cdd.latest_ts)
+
+        cdd = ChangeDataDict(set_ts=0)
+        cdd.update([(1, 5)], y='test')
+        self.assertEqual(cdd[1], 5)
+        self.assertEqual(cdd['y'], 'test')
+
+        # Like dict.update, other can be used as a keyword
+        cdd.set_ts = 1
+        cdd.update(other=1)
+        self.assertEqual(cdd['other'], 1)
+
     def test_set_and_lookup_ts(self):
         ts = 10
         cdd = ChangeDataDict(dic={1: 5}, set_ts=ts)
@@ -58,6 +82,55 @@ class TestChangeDataDict(unittest.TestCase):
         with self.assertRaises(KeyError):
             cdd[1]
 
+        # Only known lookup types are allowed
+        with self.assertRaises(ValueError):
+            cdd.lookup_type = 4
+
+    def test_lookup_after_update(self):
+        cdd = ChangeDataDict(dic={1: 5}, set_ts=0)
+        self.assertEqual(cdd[1], 5)
+
+        # Reads reflect writes in between
+        cdd.set_ts = 1
+        cdd[1] = 6
+        self.assertEqual(cdd[1], 6)
+        cdd.set_ts = 2
+        del cdd[1]
+        with self.assertRaises(KeyError):
+            cdd[1]
+
+    def test_cached_lookup_after_update(self):
+        # Lookups other than LookupType.LAST are cached per key
+        cdd = ChangeDataDict(dic={1: 5}, set_ts=0,
+                             lookup_type=LookupType.TIMESTAMP, lookup_ts=20)
+        self.assertEqual(cdd[1], 5)
+        self.assertEqual(list(cdd), [1])
+
+        cdd.set_ts = 1
+        cdd[1] = 6
+        self.assertEqual(cdd[1], 6)
+        self.assertEqual(cdd.diff(LookupType.FIRST), {1: (6, 5)})
+        cdd.set_ts = 2
+        del cdd[1]
+        with self.assertRaises(KeyError):
+            cdd[1]
+        self.assertEqual(list(cdd), [])
+        self.assertEqual(
+            cdd.diff(LookupType.FIRST), {1: (ChangeDataDict.DELETED, 5)})
+
+        # A key created after the first read
+        cdd.lookup_type = LookupType.FIRST
+        self.assertEqual(cdd[1], 5)
+        self.assertEqual(list(cdd), [1])
+        cdd.set_ts = 3
+        cdd[2] = 3
+        self.assertEqual(cdd[2], 3)
+        self.assertEqual(list(cdd), [1, 2])
+        self.assertEqual(
+            cdd.diff(LookupType.LAST),
+            {1: (5, ChangeDataDict.DELETED)}
+        )
+
     def test_delete(self):
         cdd = ChangeDataDict(
             dic={1: 5}, lookup_type=LookupType.FIRST, set_ts=0)
@@ -83,6 +156,34 @@ class TestChangeDataDict(unittest.TestCase):
         cdd[1] = 4
         self.assertEqual(cdd[1], 4)
 
+    def test_iter(self):
+        cdd = ChangeDataDict(dic={1: 5}, set_ts=0)
+        cdd.set_ts = 1
+        cdd[2] = 3
+        cdd.set_ts = 2
+        del cdd[1]
+
+        self.assertEqual(list(cdd), [2])
+        cdd.lookup_type = LookupType.FIRST
+        self.assertEqual(list(cdd), [1, 2])
+        cdd.lookup_type = LookupType.TIMESTAMP
+        cdd.lookup_ts = 0
+        self.assertEqual(list(cdd), [1])
+
+        # A key that is set again keeps its position
+        cdd.lookup_type = LookupType.LAST
+        cdd.set_ts = 3
+        cdd[1] = 6
+        self.assertEqual(list(cdd), [1, 2])
+
+    def test_delete_while_iterating(self):
+        cdd = ChangeDataDict(dic={1: 1, 2: 2, 3: 3}, set_ts=0)
+        cdd.set_ts = 1
+        for key in cdd:
+            if key == 1:
+                del cdd[key]
+        self.assertEqual(list(cdd), [2, 3])
+
     def test_lazy_update(self):
         cdd = ChangeDataDict(dic={1: 5}, set_ts=0, lazy_update=True)
         cdd.set_ts = 1
@@ -91,6 +192,15 @@ class TestChangeDataDict(unittest.TestCase):
         # Because of the lazy_update, the first item is still the only item
         self.assertEqual(cdd.prior_ts(1), 0)
 
+        # Different and unhashable values are still updated
+        cdd[1] = 6
+        self.assertEqual(cdd.prior_ts(1), 1)
+        cdd.set_ts = 2
+        cdd[1] = {'a': 1}
+        cdd.set_ts = 3
+        cdd[1] = {'a': 1}
+        self.assertEqual(cdd.prior_ts(1), 2)
+
     def test_diff(self):
         cdd = ChangeDataDict(
             dic={1: 5, 2: 3}, set_ts=5)
@@ -115,7 +225,81 @@ class TestChangeDataDict(unittest.TestCase):
             cdd.diff(LookupType.FIRST),
             {1: (ChangeDataDict.DELETED, 5)}
         )
+        # No difference with the lookup itself
+        self.assertEqual(cdd.diff(LookupType.LAST), {})
 
+        # Compare against the latest state
+        cdd.lookup_type = LookupType.TIMESTAMP
+        cdd.lookup_ts = 5
+        self.assertEqual(cdd.diff(LookupType.TIMESTAMP, lookup_ts=5), {})
+        self.assertEqual(
+            cdd.diff(LookupType.LAST),
+            {1: (5, ChangeDataDict.DELETED)}
+        )
+
+    def test_from_sorted_pairs(self):
+        cdd = ChangeDataDict.from_sorted_pairs([
+            (1, [(0, 5, False), (2, 6, False)]),
+            (2, [(1, 3, False), (3, None, True)]),
+        ])
+        self.assertEqual(cdd.latest_ts, 3)
+        self.assertEqual(cdd.to_dict(snapshot=True), {1: 6})
+        self.assertEqual(
+            cdd.to_dict()[2],
+            [{'ts': 1, 'value': 3}, {'ts': 3, 'value': None, 'del': True}]
+        )
+        cdd.lookup_type = LookupType.TIMESTAMP
+        cdd.lookup_ts = 1
+        self.assertEqual(cdd.to_dict(snapshot=True), {1: 5, 2: 3})
+
+        # Later changes are validated against the loaded history
+        cdd.set_ts = 3
+        with self.assertRaises(ValueError):
+            cdd[2] = 4
+        cdd[3] = 4
+        self.assertEqual(cdd.prior_ts(3), 3)
+
+        # A set_ts before the loaded history is not allowed
+        with self.assertRaises(ValueError):
+            ChangeDataDict.from_sorted_pairs([(1, [(5, 1, False)])], set_ts=4)
+
+        # A key loaded again ends up with its last history
+        cdd = ChangeDataDict.from_sorted_pairs([
+            (1, [(0, 1, False)]),
+            (1, [(0, 1, False), (1, None, True)]),
+        ], lazy_update=True)
+        self.assertEqual(list(cdd), [])
+        self.assertEqual(cdd.to_dict(snapshot=True), {})
+        cdd.set_ts = 2
+        cdd[1] = 2
+        self.assertEqual(cdd[1], 2)
+
+        # A reloaded key ending in a deletion behaves for lazy_update as if
+        # it was deleted through __delitem__
+        written = ChangeDataDict(dic={1: 1}, set_ts=0, lazy_update=True)
+        written.set_ts = 1
+        del written[1]
+        loaded = ChangeDataDict.from_sorted_pairs(
+            [(1, [(0, 1, False), (1, None, True)])],
+            dic={1: 1}, set_ts=1, lazy_update=True)
+        for cdd in (written, loaded):
+            cdd.set_ts = 2
+            cdd[1] = None
+        self.assertEqual(loaded.prior_ts(1), written.prior_ts(1))
+        self.assertEqual(loaded.to_dict(), written.to_dict())
+
+    def test_copy_and_pickle(self):
+        cdd = ChangeDataDict(dic={1: 5}, set_ts=0, version=1)
+        for other in (copy.deepcopy(cdd), pickle.loads(pickle.dumps(cdd))):
+            other.set_ts = 1
+            other[1] = 6
+            self.assertEqual(other[1], 6)
+            self.assertEqual(len(other.to_dict()[1]), 2)
+            self.assertEqual(other.to_dict()[1][1]['version'], 1)
+        # The original is left untouched
+        self.assertEqual(cdd[1], 5)
+        self.assertEqual(cdd.to_dict(), {1: [{'ts': 0, 'value': 5,
+                                              'version': 1}]})
 
     def test_to_dict(self):
         cdd = ChangeDataDict(dic={1: 5, 2: 3}, set_ts=0)
@@ -152,6 +336,22 @@ class TestChangeDataDict(unittest.TestCase):
             cdd.to_json(),
             '{"1": [{"ts": 0, "value": 5}, {"ts": 1, "value": 4}]}'
         )
+        self.assertEqual(cdd.to_json(snapshot=True), '{"1": 4}')
+        cdd.lookup_type = LookupType.FIRST
+        self.assertEqual(cdd.to_json(snapshot=True), '{"1": 5}')
+
+    def test_to_dict_version_and_source(self):
+        cdd = ChangeDataDict(dic={1: 5}, set_ts=0, version=2, source='test')
+        cdd.set_ts = 1
+        del cdd[1]
+        self.assertEqual(
+            cdd.to_dict(),
+            {1: [
+                {'ts': 0, 'value': 5, 'version': 2, 'source': 'test'},
+                {'ts': 1, 'value': None, 'del': True, 'version': 2,
+                 'source': 'test'},
+            ]}
+        )
 
 
 if __name__ == '__main__':